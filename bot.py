@@ -5,8 +5,8 @@ import os
 import aiosqlite
 from aiogram import Bot, Dispatcher
 
-from config import load_config
-from db import init_db
+from config import Config, load_config
+from db import init_db, open_read_db, flusher
 from handlers import setup_router
 
 logging.basicConfig(
@@ -16,25 +16,39 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-async def main() -> None:
-    config = load_config()
-
-    # Ensure data directories exist
+def _ensure_dirs(config: Config) -> None:
     os.makedirs(config.data_dir, exist_ok=True)
     if config.download_media:
         os.makedirs(config.media_dir, exist_ok=True)
 
-    # Initialize database
-    db = await init_db(str(config.db_path))
+
+async def main() -> None:
+    config = load_config()
+
+    # Ensure data directories exist. Filesystem calls run in a worker thread;
+    # aiosqlite already runs all SQLite work (including init_db) off the loop.
+    await asyncio.to_thread(_ensure_dirs, config)
+
+    # Initialize database: one writer connection, one read-only connection
+    write_db = await init_db(str(config.db_path))
+    read_db = await open_read_db(str(config.db_path))
+    write_lock = asyncio.Lock()
     logger.info("Database initialized at %s", config.db_path)
 
+    # Writes from handlers are queued and committed in batches
+    write_queue: asyncio.Queue = asyncio.Queue()
+    flush_task = asyncio.create_task(flusher(write_db, write_queue, lock=write_lock))
+
     # Setup bot and dispatcher
     bot = Bot(token=config.bot_token)
     dp = Dispatcher()
 
     # Inject dependencies via aiogram DI
-    dp["db"] = db
+    dp["db_write"] = write_db
+    dp["db_read"] = read_db
+    dp["write_lock"] = write_lock
     dp["config"] = config
+    dp["write_queue"] = write_queue
 
     # Register handlers
     router = setup_router()
@@ -42,8 +56,11 @@ async def main() -> None:
 
     # Shutdown hook
     async def on_shutdown() -> None:
-        logger.info("Shutting down, closing database...")
-        await db.close()
+        logger.info("Shutting down, flushing pending writes and closing database...")
+        await write_queue.put(None)
+        await flush_task
+        await read_db.close()
+        await write_db.close()
 
     dp.shutdown.register(on_shutdown)
 
@@ -1,9 +1,13 @@
+import functools
 import os
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional
 
-from dotenv import load_dotenv
+from dotenv import dotenv_values, find_dotenv
+
+
+_TRUE_VALUES = frozenset({"true", "1", "yes", "y", "on"})
 
 
 @dataclass
@@ -21,15 +25,25 @@ class Config:
         return self.data_dir / "media"
 
 
+@functools.lru_cache(maxsize=8)
+def _read_dotenv(env_path: Optional[str], mtime: float) -> Dict[str, Optional[str]]:
+    """Parse a .env file once per (path, mtime); edits to the file re-parse it."""
+    return dotenv_values(env_path)
+
+
 def load_config(env_path: Optional[str] = None) -> Config:
-    load_dotenv(env_path)
+    env_path = env_path or find_dotenv() or None
+    mtime = os.path.getmtime(env_path) if env_path and os.path.exists(env_path) else 0.0
+    # Applied on every call, like load_dotenv: existing env vars win
+    for key, value in _read_dotenv(env_path, mtime).items():
+        if value is not None:
+            os.environ.setdefault(key, value)
 
     bot_token = os.getenv("BOT_TOKEN")
     if not bot_token:
         raise ValueError("BOT_TOKEN is required. Set it in .env file.")
 
-    download_media_raw = os.getenv("DOWNLOAD_MEDIA", "false").strip().lower()
-    download_media = download_media_raw in ("true", "1", "yes")
+    download_media = os.getenv("DOWNLOAD_MEDIA", "").strip().casefold() in _TRUE_VALUES
 
     data_dir = Path(os.getenv("DATA_DIR", "./data"))
 
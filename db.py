@@ -1,7 +1,12 @@
-import json
-from typing import Optional
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, Final, List, Optional, Tuple
 
 import aiosqlite
+import orjson
+
+logger = logging.getLogger(__name__)
 
 SCHEMA_SQL = """
 CREATE TABLE IF NOT EXISTS chats (
@@ -20,7 +25,7 @@ CREATE TABLE IF NOT EXISTS users (
 );
 
 CREATE TABLE IF NOT EXISTS messages (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    id INTEGER PRIMARY KEY,
     msg_id INTEGER NOT NULL,
     chat_id INTEGER NOT NULL REFERENCES chats(chat_id),
     user_id INTEGER REFERENCES users(user_id),
@@ -33,49 +38,117 @@ CREATE TABLE IF NOT EXISTS messages (
     fwd_from INTEGER,
     fwd_name TEXT,
     is_edit INTEGER DEFAULT 0,
-    created_at TEXT DEFAULT (datetime('now'))
+    created_at TEXT
 );
 
 CREATE TABLE IF NOT EXISTS events (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    id INTEGER PRIMARY KEY,
     chat_id INTEGER NOT NULL REFERENCES chats(chat_id),
     user_id INTEGER,
     type TEXT NOT NULL,
     data TEXT,
     date TEXT NOT NULL,
-    created_at TEXT DEFAULT (datetime('now'))
+    created_at TEXT
 );
 
 CREATE INDEX IF NOT EXISTS idx_messages_chat_date ON messages(chat_id, date);
-CREATE INDEX IF NOT EXISTS idx_messages_user ON messages(user_id);
+DROP INDEX IF EXISTS idx_messages_user;
+CREATE INDEX IF NOT EXISTS idx_messages_user_date ON messages(user_id, date);
 CREATE INDEX IF NOT EXISTS idx_messages_msg_chat ON messages(msg_id, chat_id);
 CREATE INDEX IF NOT EXISTS idx_events_chat_date ON events(chat_id, date);
 """
 
+# Statement texts are module constants so every call hands sqlite3 the same
+# string and hits its per-connection prepared statement cache.
+UPSERT_CHAT_SQL: Final = """
+INSERT INTO chats (chat_id, title, type, updated_at)
+VALUES (?, ?, ?, ?)
+ON CONFLICT(chat_id) DO UPDATE SET
+    title = excluded.title,
+    type = excluded.type,
+    updated_at = excluded.updated_at
+"""
+
+UPSERT_USER_SQL: Final = """
+INSERT INTO users (user_id, username, first_name, last_name, updated_at)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(user_id) DO UPDATE SET
+    username = excluded.username,
+    first_name = excluded.first_name,
+    last_name = excluded.last_name,
+    updated_at = excluded.updated_at
+"""
+
+# Messages without media (the common case) skip the two media columns
+INSERT_TEXT_SQL: Final = """
+INSERT INTO messages
+    (msg_id, chat_id, user_id, date, type, text,
+     reply_to, fwd_from, fwd_name, is_edit, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_MEDIA_SQL: Final = """
+INSERT INTO messages
+    (msg_id, chat_id, user_id, date, type, text, media_file_id,
+     media_meta, reply_to, fwd_from, fwd_name, is_edit, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_EVENT_SQL: Final = """
+INSERT INTO events (chat_id, user_id, type, data, date, created_at)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# Upserts are keyed on their first parameter, so within one batch only the
+# latest row per chat/user needs to be written.
+_UPSERT_SQL = frozenset({UPSERT_CHAT_SQL, UPSERT_USER_SQL})
+
+# Both fill the messages table, whose rowid is the arrival order; a batch
+# may only merge consecutive message rows that use the same statement.
+_MESSAGE_SQL = frozenset({INSERT_TEXT_SQL, INSERT_MEDIA_SQL})
+
+# Background flusher limits: commit at most every FLUSH_INTERVAL seconds,
+# or sooner once FLUSH_MAX_ROWS rows are waiting.
+FLUSH_INTERVAL = 0.05
+FLUSH_MAX_ROWS = 500
+
+
+def utc_now() -> str:
+    """Current UTC time in the same format as SQLite's datetime('now')."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
 
 async def init_db(db_path: str) -> aiosqlite.Connection:
     db = await aiosqlite.connect(db_path)
     await db.execute("PRAGMA journal_mode=WAL")
+    # WAL only needs fsync at checkpoints; NORMAL skips the per-commit fsync
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+    await db.execute("PRAGMA cache_size=-20000")  # 20 MiB page cache
+    await db.execute("PRAGMA wal_autocheckpoint=1000")
+    await db.execute("PRAGMA busy_timeout=5000")
     await db.executescript(SCHEMA_SQL)
     await db.commit()
     return db
 
 
+async def open_read_db(db_path: str) -> aiosqlite.Connection:
+    """Open a read-only connection alongside the writer returned by init_db."""
+    db = await aiosqlite.connect(db_path)
+    await db.execute("PRAGMA query_only=ON")
+    await db.execute("PRAGMA busy_timeout=5000")
+    return db
+
+
 async def upsert_chat(
     db: aiosqlite.Connection,
     chat_id: int,
     title: Optional[str],
     chat_type: Optional[str],
+    updated_at: Optional[str] = None,
 ) -> None:
-    await db.execute(
-        """INSERT INTO chats (chat_id, title, type, updated_at)
-           VALUES (?, ?, ?, datetime('now'))
-           ON CONFLICT(chat_id) DO UPDATE SET
-               title = excluded.title,
-               type = excluded.type,
-               updated_at = datetime('now')""",
-        (chat_id, title, chat_type),
-    )
+    await db.execute(UPSERT_CHAT_SQL, (chat_id, title, chat_type, updated_at or utc_now()))
 
 
 async def upsert_user(
@@ -84,21 +157,15 @@ async def upsert_user(
     username: Optional[str],
     first_name: Optional[str],
     last_name: Optional[str],
+    updated_at: Optional[str] = None,
 ) -> None:
     await db.execute(
-        """INSERT INTO users (user_id, username, first_name, last_name, updated_at)
-           VALUES (?, ?, ?, ?, datetime('now'))
-           ON CONFLICT(user_id) DO UPDATE SET
-               username = excluded.username,
-               first_name = excluded.first_name,
-               last_name = excluded.last_name,
-               updated_at = datetime('now')""",
-        (user_id, username, first_name, last_name),
+        UPSERT_USER_SQL,
+        (user_id, username, first_name, last_name, updated_at or utc_now()),
     )
 
 
-async def insert_message(
-    db: aiosqlite.Connection,
+def _message_row(
     msg_id: int,
     chat_id: int,
     user_id: Optional[int],
@@ -111,47 +178,230 @@ async def insert_message(
     fwd_from: Optional[int] = None,
     fwd_name: Optional[str] = None,
     is_edit: bool = False,
-) -> None:
+    created_at: Optional[str] = None,
+) -> Tuple[str, tuple]:
+    """Build the (sql, params) pair for a message row."""
+    created_at = created_at or utc_now()
+    if media_file_id is None and media_meta is None:
+        return INSERT_TEXT_SQL, (
+            msg_id, chat_id, user_id, date, msg_type, text,
+            reply_to, fwd_from, fwd_name, 1 if is_edit else 0, created_at,
+        )
+
     meta_json = None
     if media_meta:
         # Only include non-null fields to save space
-        meta_json = json.dumps(
+        meta_json = orjson.dumps(
             {k: v for k, v in media_meta.items() if v is not None},
-            ensure_ascii=False,
-        )
+        ).decode()
 
-    await db.execute(
-        """INSERT INTO messages
-           (msg_id, chat_id, user_id, date, type, text, media_file_id,
-            media_meta, reply_to, fwd_from, fwd_name, is_edit)
-           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (
-            msg_id, chat_id, user_id, date, msg_type, text,
-            media_file_id, meta_json, reply_to, fwd_from, fwd_name,
-            1 if is_edit else 0,
-        ),
+    return INSERT_MEDIA_SQL, (
+        msg_id, chat_id, user_id, date, msg_type, text,
+        media_file_id, meta_json, reply_to, fwd_from, fwd_name,
+        1 if is_edit else 0, created_at,
     )
 
 
-async def insert_event(
-    db: aiosqlite.Connection,
+def _event_params(
     chat_id: int,
     event_type: str,
     date: str,
     user_id: Optional[int] = None,
     data: Optional[dict] = None,
-) -> None:
+    created_at: Optional[str] = None,
+) -> tuple:
     data_json = None
     if data:
-        data_json = json.dumps(data, ensure_ascii=False)
+        data_json = orjson.dumps(data).decode()
+
+    return (chat_id, user_id, event_type, data_json, date, created_at or utc_now())
+
+
+async def insert_message(
+    db: aiosqlite.Connection,
+    msg_id: int,
+    chat_id: int,
+    user_id: Optional[int],
+    date: str,
+    msg_type: str,
+    text: Optional[str] = None,
+    media_file_id: Optional[str] = None,
+    media_meta: Optional[dict] = None,
+    reply_to: Optional[int] = None,
+    fwd_from: Optional[int] = None,
+    fwd_name: Optional[str] = None,
+    is_edit: bool = False,
+    created_at: Optional[str] = None,
+) -> None:
+    await db.execute(*_message_row(
+        msg_id, chat_id, user_id, date, msg_type, text, media_file_id,
+        media_meta, reply_to, fwd_from, fwd_name, is_edit, created_at,
+    ))
 
+
+async def insert_event(
+    db: aiosqlite.Connection,
+    chat_id: int,
+    event_type: str,
+    date: str,
+    user_id: Optional[int] = None,
+    data: Optional[dict] = None,
+    created_at: Optional[str] = None,
+) -> None:
     await db.execute(
-        """INSERT INTO events (chat_id, user_id, type, data, date)
-           VALUES (?, ?, ?, ?, ?)""",
-        (chat_id, user_id, event_type, data_json, date),
+        INSERT_EVENT_SQL,
+        _event_params(chat_id, event_type, date, user_id, data, created_at),
     )
 
 
 async def commit(db: aiosqlite.Connection) -> None:
     """Commit all pending changes. Call once after all operations for a message."""
     await db.commit()
+
+
+async def _write_rows(db: aiosqlite.Connection, rows: List[Tuple[str, tuple]]) -> None:
+    """Write (sql, params) rows in one transaction, one executemany per statement.
+
+    Repeated chat/user upserts for the same id collapse into the latest one.
+    Message rows keep their relative order across the text and media
+    statements, so messages.id stays in arrival order.
+    """
+    grouped: Dict[Any, Tuple[str, Dict[Any, tuple]]] = {}
+    message_run = 0
+    last_message_sql = None
+    for i, (sql, params) in enumerate(rows):
+        group = sql
+        if sql in _UPSERT_SQL:
+            key = params[0]
+        else:
+            key = i
+            if sql in _MESSAGE_SQL:
+                if sql != last_message_sql:
+                    message_run += 1
+                    last_message_sql = sql
+                group = (sql, message_run)
+        grouped.setdefault(group, (sql, {}))[1][key] = params
+
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        for sql, params_by_key in grouped.values():
+            await db.executemany(sql, list(params_by_key.values()))
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+
+
+class MessageTxn:
+    """Collect all writes for one update and flush them together.
+
+    Without a queue, rows are written on exit in a single transaction with
+    one ``executemany`` per statement. With a queue, the update's rows are
+    handed to ``flusher`` as one item and committed with other updates.
+    Nothing is written if the ``async with`` body raises.
+
+    Usage::
+
+        async with MessageTxn(db, write_queue) as tx:
+            tx.add_chat(chat_id, title, chat_type)
+            tx.add_message(msg_id=..., chat_id=..., ...)
+    """
+
+    def __init__(self, db: aiosqlite.Connection, queue: Optional[asyncio.Queue] = None) -> None:
+        self._db = db
+        self._queue = queue
+        self._rows: List[Tuple[str, tuple]] = []
+        # One timestamp for every row of the update
+        self.now = utc_now()
+
+    def add_chat(self, chat_id: int, title: Optional[str], chat_type: Optional[str]) -> None:
+        self._rows.append((UPSERT_CHAT_SQL, (chat_id, title, chat_type, self.now)))
+
+    def add_user(
+        self,
+        user_id: int,
+        username: Optional[str],
+        first_name: Optional[str],
+        last_name: Optional[str],
+    ) -> None:
+        self._rows.append((UPSERT_USER_SQL, (user_id, username, first_name, last_name, self.now)))
+
+    def add_message(self, **kwargs) -> None:
+        """Queue a message row. Accepts the same keyword arguments as insert_message."""
+        kwargs.setdefault("created_at", self.now)
+        self._rows.append(_message_row(**kwargs))
+
+    def add_event(self, **kwargs) -> None:
+        """Queue an event row. Accepts the same keyword arguments as insert_event."""
+        kwargs.setdefault("created_at", self.now)
+        self._rows.append((INSERT_EVENT_SQL, _event_params(**kwargs)))
+
+    async def __aenter__(self) -> "MessageTxn":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None or not self._rows:
+            return
+
+        if self._queue is not None:
+            self._queue.put_nowait(self._rows)
+        else:
+            await _write_rows(self._db, self._rows)
+
+
+async def flusher(
+    db: aiosqlite.Connection,
+    queue: asyncio.Queue,
+    interval: float = FLUSH_INTERVAL,
+    max_rows: int = FLUSH_MAX_ROWS,
+    lock: Optional[asyncio.Lock] = None,
+) -> None:
+    """Commit queued MessageTxn rows in batches until a None sentinel is received.
+
+    Each batch waits at most ``interval`` seconds after its first item or
+    until ``max_rows`` rows are collected, then is written in one transaction.
+    If that transaction fails, the batch is retried one update at a time so
+    a single bad update does not take the others down with it.
+    If ``lock`` is given it is held while the batch is written, so other
+    users of the write connection never interleave with a flush.
+    """
+    lock = lock or asyncio.Lock()
+    loop = asyncio.get_running_loop()
+    stopping = False
+
+    while not stopping:
+        item = await queue.get()
+        if item is None:
+            break
+
+        items = [item]
+        n_rows = len(item)
+        deadline = loop.time() + interval
+        while n_rows < max_rows:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                stopping = True
+                break
+            items.append(item)
+            n_rows += len(item)
+
+        async with lock:
+            try:
+                await _write_rows(db, [row for rows in items for row in rows])
+            except Exception:
+                if len(items) == 1:
+                    logger.exception("Error flushing %d queued rows", n_rows)
+                    continue
+                logger.warning("Batch of %d updates failed, retrying one by one", len(items), exc_info=True)
+                # Only the update that actually fails is dropped
+                for rows in items:
+                    try:
+                        await _write_rows(db, rows)
+                    except Exception:
+                        logger.exception("Error flushing %d queued rows", len(rows))
@@ -1,6 +1,8 @@
+import asyncio
 import logging
 import os
 import re
+import string
 from typing import Optional, Tuple
 
 import aiosqlite
@@ -9,11 +11,11 @@ from aiogram.enums import ContentType
 from aiogram.types import Message, MessageOriginUser, MessageOriginChat, MessageOriginHiddenUser, MessageOriginChannel
 
 from config import Config
-from db import upsert_chat, upsert_user, insert_message, insert_event, commit
+from db import MessageTxn
 
 logger = logging.getLogger(__name__)
 
-MEDIA_CONTENT_TYPES = {
+MEDIA_CONTENT_TYPES = frozenset({
     ContentType.PHOTO,
     ContentType.VIDEO,
     ContentType.DOCUMENT,
@@ -22,14 +24,22 @@ MEDIA_CONTENT_TYPES = {
     ContentType.VIDEO_NOTE,
     ContentType.STICKER,
     ContentType.ANIMATION,
-}
+})
 
-SERVICE_CONTENT_TYPES = {
+SERVICE_CONTENT_TYPES = frozenset({
     ContentType.NEW_CHAT_MEMBERS,
     ContentType.LEFT_CHAT_MEMBER,
     ContentType.NEW_CHAT_TITLE,
     ContentType.PINNED_MESSAGE,
-}
+})
+
+# Filename sanitizing: a translate table for the common ASCII case, and the
+# equivalent regex for names with non-ASCII characters (which \w accepts).
+_SAFE_FILENAME_CHARS = frozenset(string.ascii_letters + string.digits + "_-.")
+_FILENAME_TABLE = str.maketrans({
+    c: '_' for c in map(chr, range(128)) if c not in _SAFE_FILENAME_CHARS
+})
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w\-.]')
 
 
 def _extract_forward_info(message: Message) -> Tuple[Optional[int], Optional[str]]:
@@ -50,84 +60,106 @@ def _extract_forward_info(message: Message) -> Tuple[Optional[int], Optional[str
     return None, None
 
 
+def _photo_meta(photos) -> Tuple[str, dict]:
+    photo = photos[-1]  # largest size
+    return photo.file_id, {
+        "size": photo.file_size,
+        "width": photo.width,
+        "height": photo.height,
+    }
+
+
+def _video_meta(v) -> Tuple[str, dict]:
+    return v.file_id, {
+        "size": v.file_size,
+        "mime": v.mime_type,
+        "name": v.file_name,
+        "duration": v.duration,
+        "width": v.width,
+        "height": v.height,
+    }
+
+
+def _document_meta(d) -> Tuple[str, dict]:
+    return d.file_id, {
+        "size": d.file_size,
+        "mime": d.mime_type,
+        "name": d.file_name,
+    }
+
+
+def _audio_meta(a) -> Tuple[str, dict]:
+    return a.file_id, {
+        "size": a.file_size,
+        "mime": a.mime_type,
+        "name": a.file_name,
+        "duration": a.duration,
+    }
+
+
+def _voice_meta(v) -> Tuple[str, dict]:
+    return v.file_id, {
+        "size": v.file_size,
+        "mime": v.mime_type,
+        "duration": v.duration,
+    }
+
+
+def _video_note_meta(vn) -> Tuple[str, dict]:
+    return vn.file_id, {
+        "size": vn.file_size,
+        "duration": vn.duration,
+        "length": vn.length,
+    }
+
+
+def _sticker_meta(s) -> Tuple[str, dict]:
+    return s.file_id, {
+        "emoji": s.emoji,
+        "set_name": s.set_name,
+        "width": s.width,
+        "height": s.height,
+    }
+
+
+def _animation_meta(a) -> Tuple[str, dict]:
+    return a.file_id, {
+        "size": a.file_size,
+        "mime": a.mime_type,
+        "name": a.file_name,
+        "duration": a.duration,
+        "width": a.width,
+        "height": a.height,
+    }
+
+
+# content type -> (Message attribute, meta builder); the attribute name
+# doubles as the stored message type.
+_META_BUILDERS = {
+    ContentType.PHOTO: ("photo", _photo_meta),
+    ContentType.VIDEO: ("video", _video_meta),
+    ContentType.DOCUMENT: ("document", _document_meta),
+    ContentType.AUDIO: ("audio", _audio_meta),
+    ContentType.VOICE: ("voice", _voice_meta),
+    ContentType.VIDEO_NOTE: ("video_note", _video_note_meta),
+    ContentType.STICKER: ("sticker", _sticker_meta),
+    ContentType.ANIMATION: ("animation", _animation_meta),
+}
+
+
 def _extract_media_meta(message: Message) -> Tuple[Optional[str], Optional[dict], str]:
     """Extract media metadata, file_id, and content type string from message.
 
     Returns: (file_id, media_meta_dict, type_string)
     """
     ct = message.content_type
-
-    if ct == ContentType.PHOTO and message.photo:
-        photo = message.photo[-1]  # largest size
-        return photo.file_id, {
-            "size": photo.file_size,
-            "width": photo.width,
-            "height": photo.height,
-        }, "photo"
-
-    if ct == ContentType.VIDEO and message.video:
-        v = message.video
-        return v.file_id, {
-            "size": v.file_size,
-            "mime": v.mime_type,
-            "name": v.file_name,
-            "duration": v.duration,
-            "width": v.width,
-            "height": v.height,
-        }, "video"
-
-    if ct == ContentType.DOCUMENT and message.document:
-        d = message.document
-        return d.file_id, {
-            "size": d.file_size,
-            "mime": d.mime_type,
-            "name": d.file_name,
-        }, "document"
-
-    if ct == ContentType.AUDIO and message.audio:
-        a = message.audio
-        return a.file_id, {
-            "size": a.file_size,
-            "mime": a.mime_type,
-            "name": a.file_name,
-            "duration": a.duration,
-        }, "audio"
-
-    if ct == ContentType.VOICE and message.voice:
-        v = message.voice
-        return v.file_id, {
-            "size": v.file_size,
-            "mime": v.mime_type,
-            "duration": v.duration,
-        }, "voice"
-
-    if ct == ContentType.VIDEO_NOTE and message.video_note:
-        vn = message.video_note
-        return vn.file_id, {
-            "size": vn.file_size,
-            "duration": vn.duration,
-            "length": vn.length,
-        }, "video_note"
-
-    if ct == ContentType.STICKER and message.sticker:
-        s = message.sticker
-        return s.file_id, {
-            "emoji": s.emoji,
-            "set_name": s.set_name,
-            "width": s.width,
-            "height": s.height,
-        }, "sticker"
-
-    if ct == ContentType.ANIMATION and message.animation:
-        a = message.animation
-        return a.file_id, {
-            "size": a.file_size,
-            "mime": a.mime_type,
-            "name": a.file_name,
-            "duration": a.duration,
-            "width": a.width,
-            "height": a.height,
-        }, "animation"
+    entry = _META_BUILDERS.get(ct)
+    if entry is not None:
+        attr, build = entry
+        media = getattr(message, attr)
+        if media:
+            file_id, meta = build(media)
+            return file_id, meta, attr
 
     return None, None, str(ct) if ct else "unknown"
 
@@ -135,23 +167,36 @@ def _extract_media_meta(message: Message) -> Tuple[Optional[str], Optional[dict]
 def _sanitize_filename(name: str) -> str:
     """Remove unsafe characters from filename."""
     name = os.path.basename(name)
-    return re.sub(r'[^\w\-.]', '_', name)
+    if name.isascii():
+        return name.translate(_FILENAME_TABLE)
+    return _UNSAFE_FILENAME_RE.sub('_', name)
+
+
+async def _download_media(message: Message, config: Config, file_id: str) -> None:
+    """Download a media file into config.media_dir, logging (not raising) failures."""
+    try:
+        file = await message.bot.get_file(file_id)
+        safe_name = _sanitize_filename(file.file_path.split('/')[-1])
+        dest = os.path.join(config.media_dir, f"{message.chat.id}_{message.message_id}_{safe_name}")
+        await message.bot.download_file(file.file_path, dest)
+    except Exception:
+        logger.exception("Error downloading media for message %s", message.message_id)
 
 
-async def _save_chat_and_user(db: aiosqlite.Connection, message: Message) -> None:
-    """Upsert chat and user info from a message."""
-    await upsert_chat(db, message.chat.id, message.chat.title, message.chat.type)
+def _save_chat_and_user(tx: MessageTxn, message: Message) -> None:
+    """Queue chat and user upserts for a message."""
+    tx.add_chat(message.chat.id, message.chat.title, message.chat.type)
     if message.from_user:
-        await upsert_user(
-            db, message.from_user.id,
+        tx.add_user(
+            message.from_user.id,
             message.from_user.username,
             message.from_user.first_name,
             message.from_user.last_name,
         )
 
 
-async def _log_message(
-    db: aiosqlite.Connection,
+def _log_message(
+    tx: MessageTxn,
     message: Message,
     msg_type: str,
     text: Optional[str] = None,
@@ -163,8 +208,7 @@ async def _log_message(
     fwd_from, fwd_name = _extract_forward_info(message)
     user_id = message.from_user.id if message.from_user else None
 
-    await insert_message(
-        db,
+    tx.add_message(
         msg_id=message.message_id,
         chat_id=message.chat.id,
         user_id=user_id,
@@ -178,7 +222,16 @@ async def _log_message(
         fwd_name=fwd_name,
         is_edit=is_edit,
     )
-    await commit(db)
+
+
+async def _is_non_command_text(message: Message) -> bool:
+    """Filter for text messages that are not bot commands.
+
+    A coroutine so aiogram awaits it directly; sync filters (including
+    magic ``F`` filters) are dispatched through a worker thread.
+    """
+    text = message.text
+    return bool(text) and text[0] != "/"
 
 
 def setup_router() -> Router:
@@ -186,118 +239,133 @@ def setup_router() -> Router:
     router = Router()
 
     # --- Text messages ---
-    @router.message(F.text, ~F.text.startswith("/"))
-    async def on_text(message: Message, db: aiosqlite.Connection, config: Config) -> None:
+    @router.message(_is_non_command_text)
+    async def on_text(
+        message: Message, db_write: aiosqlite.Connection, config: Config, write_queue: asyncio.Queue,
+    ) -> None:
         try:
-            await _save_chat_and_user(db, message)
-            await _log_message(db, message, msg_type="text", text=message.text)
+            async with MessageTxn(db_write, write_queue) as tx:
+                _save_chat_and_user(tx, message)
+                _log_message(tx, message, msg_type="text", text=message.text)
         except Exception:
             logger.exception("Error logging text message %s in chat %s", message.message_id, message.chat.id)
 
     # --- Media messages ---
     @router.message(F.content_type.in_(MEDIA_CONTENT_TYPES))
-    async def on_media(message: Message, db: aiosqlite.Connection, config: Config) -> None:
+    async def on_media(
+        message: Message, db_write: aiosqlite.Connection, config: Config, write_queue: asyncio.Queue,
+    ) -> None:
         try:
-            await _save_chat_and_user(db, message)
             file_id, meta, msg_type = _extract_media_meta(message)
 
+            # The row only needs file_id, so the download runs alongside the write
+            download = None
             if config.download_media and file_id:
-                try:
-                    file = await message.bot.get_file(file_id)
-                    media_dir = config.media_dir
-                    os.makedirs(media_dir, exist_ok=True)
-                    safe_name = _sanitize_filename(file.file_path.split('/')[-1])
-                    dest = os.path.join(media_dir, f"{message.chat.id}_{message.message_id}_{safe_name}")
-                    await message.bot.download_file(file.file_path, dest)
-                except Exception:
-                    logger.exception("Error downloading media for message %s", message.message_id)
-
-            await _log_message(
-                db, message, msg_type=msg_type,
-                text=message.caption,
-                media_file_id=file_id,
-                media_meta=meta,
-            )
+                download = asyncio.create_task(_download_media(message, config, file_id))
+
+            try:
+                async with MessageTxn(db_write, write_queue) as tx:
+                    _save_chat_and_user(tx, message)
+                    _log_message(
+                        tx, message, msg_type=msg_type,
+                        text=message.caption,
+                        media_file_id=file_id,
+                        media_meta=meta,
+                    )
+            finally:
+                if download is not None:
+                    await download
         except Exception:
             logger.exception("Error logging media message %s in chat %s", message.message_id, message.chat.id)
 
     # --- Service events ---
     @router.message(F.content_type.in_(SERVICE_CONTENT_TYPES))
-    async def on_service(message: Message, db: aiosqlite.Connection, config: Config) -> None:
+    async def on_service(
+        message: Message, db_write: aiosqlite.Connection, config: Config, write_queue: asyncio.Queue,
+    ) -> None:
         try:
-            await _save_chat_and_user(db, message)
             date = message.date.isoformat()
 
-            if message.new_chat_members:
-                for member in message.new_chat_members:
-                    await upsert_user(db, member.id, member.username, member.first_name, member.last_name)
-                    await insert_event(
-                        db, chat_id=message.chat.id, event_type="member_joined",
+            async with MessageTxn(db_write, write_queue) as tx:
+                _save_chat_and_user(tx, message)
+
+                if message.new_chat_members:
+                    for member in message.new_chat_members:
+                        tx.add_user(member.id, member.username, member.first_name, member.last_name)
+                        tx.add_event(
+                            chat_id=message.chat.id, event_type="member_joined",
+                            date=date, user_id=member.id,
+                            data={"username": member.username, "first_name": member.first_name},
+                        )
+
+                elif message.left_chat_member:
+                    member = message.left_chat_member
+                    tx.add_event(
+                        chat_id=message.chat.id, event_type="member_left",
                         date=date, user_id=member.id,
                         data={"username": member.username, "first_name": member.first_name},
                     )
 
-            elif message.left_chat_member:
-                member = message.left_chat_member
-                await insert_event(
-                    db, chat_id=message.chat.id, event_type="member_left",
-                    date=date, user_id=member.id,
-                    data={"username": member.username, "first_name": member.first_name},
-                )
-
-            elif message.new_chat_title:
-                await upsert_chat(db, message.chat.id, message.new_chat_title, message.chat.type)
-                await insert_event(
-                    db, chat_id=message.chat.id, event_type="title_changed",
-                    date=date, user_id=message.from_user.id if message.from_user else None,
-                    data={"new_title": message.new_chat_title},
-                )
-
-            elif message.pinned_message:
-                await insert_event(
-                    db, chat_id=message.chat.id, event_type="message_pinned",
-                    date=date, user_id=message.from_user.id if message.from_user else None,
-                    data={"pinned_message_id": message.pinned_message.message_id},
-                )
+                elif message.new_chat_title:
+                    tx.add_chat(message.chat.id, message.new_chat_title, message.chat.type)
+                    tx.add_event(
+                        chat_id=message.chat.id, event_type="title_changed",
+                        date=date, user_id=message.from_user.id if message.from_user else None,
+                        data={"new_title": message.new_chat_title},
+                    )
 
-            await commit(db)
+                elif message.pinned_message:
+                    tx.add_event(
+                        chat_id=message.chat.id, event_type="message_pinned",
+                        date=date, user_id=message.from_user.id if message.from_user else None,
+                        data={"pinned_message_id": message.pinned_message.message_id},
+                    )
 
         except Exception:
             logger.exception("Error logging service event in chat %s", message.chat.id)
 
     # --- Edited messages ---
     @router.edited_message(F.text)
-    async def on_edited_text(message: Message, db: aiosqlite.Connection, config: Config) -> None:
+    async def on_edited_text(
+        message: Message, db_write: aiosqlite.Connection, config: Config, write_queue: asyncio.Queue,
+    ) -> None:
         try:
-            await _save_chat_and_user(db, message)
-            await _log_message(db, message, msg_type="text", text=message.text, is_edit=True)
+            async with MessageTxn(db_write, write_queue) as tx:
+                _save_chat_and_user(tx, message)
+                _log_message(tx, message, msg_type="text", text=message.text, is_edit=True)
         except Exception:
             logger.exception("Error logging edited text message %s in chat %s", message.message_id, message.chat.id)
 
     @router.edited_message(F.content_type.in_(MEDIA_CONTENT_TYPES))
-    async def on_edited_media(message: Message, db: aiosqlite.Connection, config: Config) -> None:
+    async def on_edited_media(
+        message: Message, db_write: aiosqlite.Connection, config: Config, write_queue: asyncio.Queue,
+    ) -> None:
         try:
-            await _save_chat_and_user(db, message)
             file_id, meta, msg_type = _extract_media_meta(message)
-            await _log_message(
-                db, message, msg_type=msg_type,
-                text=message.caption,
-                media_file_id=file_id,
-                media_meta=meta,
-                is_edit=True,
-            )
+            async with MessageTxn(db_write, write_queue) as tx:
+                _save_chat_and_user(tx, message)
+                _log_message(
+                    tx, message, msg_type=msg_type,
+                    text=message.caption,
+                    media_file_id=file_id,
+                    media_meta=meta,
+                    is_edit=True,
+                )
         except Exception:
             logger.exception("Error logging edited media message %s in chat %s", message.message_id, message.chat.id)
 
     # --- Catch-all for unknown message types ---
     @router.message()
-    async def on_other(message: Message, db: aiosqlite.Connection, config: Config) -> None:
+    async def on_other(
+        message: Message, db_write: aiosqlite.Connection, config: Config, write_queue: asyncio.Queue,
+    ) -> None:
         try:
-            await _save_chat_and_user(db, message)
-            await _log_message(
-                db, message, msg_type="other",
-                text=str(message.content_type),
-            )
+            async with MessageTxn(db_write, write_queue) as tx:
+                _save_chat_and_user(tx, message)
+                _log_message(
+                    tx, message, msg_type="other",
+                    text=str(message.content_type),
+                )
         except Exception:
             logger.exception("Error logging unknown message type in chat %s", message.chat.id)
 
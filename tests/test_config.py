@@ -1,17 +1,24 @@
 import os
 from pathlib import Path
 
+from unittest.mock import patch
+
 import pytest
+from dotenv import dotenv_values
 
-from config import load_config
+from config import load_config, _read_dotenv
 
 
 @pytest.fixture(autouse=True)
 def _clean_env(monkeypatch):
-    """Remove BOT_TOKEN from env before each test."""
-    monkeypatch.delenv("BOT_TOKEN", raising=False)
-    monkeypatch.delenv("DOWNLOAD_MEDIA", raising=False)
-    monkeypatch.delenv("DATA_DIR", raising=False)
+    """Remove config vars from env before each test and restore them after.
+
+    Setting each one first makes monkeypatch record it, so values that
+    load_config copies in from a .env file are removed again on teardown.
+    """
+    for name in ("BOT_TOKEN", "DOWNLOAD_MEDIA", "DATA_DIR"):
+        monkeypatch.setenv(name, "")
+        monkeypatch.delenv(name)
 
 
 def test_missing_bot_token_raises(monkeypatch):
@@ -31,10 +38,14 @@ def test_bot_token_loaded(monkeypatch):
     ("TRUE", True),
     ("1", True),
     ("yes", True),
+    ("y", True),
+    ("on", True),
+    (" true ", True),
     ("false", False),
     ("False", False),
     ("0", False),
     ("no", False),
+    ("off", False),
     ("", False),
 ])
 def test_download_media_parsing(monkeypatch, value, expected):
@@ -73,3 +84,39 @@ def test_media_dir_property(monkeypatch):
     monkeypatch.setenv("BOT_TOKEN", "token")
     cfg = load_config(env_path="/dev/null")
     assert cfg.media_dir == Path("./data/media")
+
+
+def test_dotenv_parsed_once_until_modified(monkeypatch, tmp_path):
+    monkeypatch.setenv("BOT_TOKEN", "token")
+    env_file = tmp_path / ".env"
+    env_file.write_text("DOWNLOAD_MEDIA=false\n")
+    _read_dotenv.cache_clear()
+
+    with patch("config.dotenv_values", wraps=dotenv_values) as spy:
+        load_config(env_path=str(env_file))
+        load_config(env_path=str(env_file))
+        assert spy.call_count == 1
+
+        mtime = os.path.getmtime(env_file)
+        os.utime(env_file, (mtime + 10, mtime + 10))
+        load_config(env_path=str(env_file))
+        assert spy.call_count == 2
+
+
+def test_cached_dotenv_reapplied_after_env_cleared(tmp_path):
+    env_file = tmp_path / ".env"
+    env_file.write_text("BOT_TOKEN=abc\n")
+    _read_dotenv.cache_clear()
+
+    assert load_config(env_path=str(env_file)).bot_token == "abc"
+    del os.environ["BOT_TOKEN"]
+    assert load_config(env_path=str(env_file)).bot_token == "abc"
+
+
+def test_dotenv_does_not_override_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("BOT_TOKEN", "from_env")
+    env_file = tmp_path / ".env"
+    env_file.write_text("BOT_TOKEN=from_file\n")
+    _read_dotenv.cache_clear()
+
+    assert load_config(env_path=str(env_file)).bot_token == "from_env"
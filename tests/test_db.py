@@ -1,13 +1,15 @@
+import asyncio
 import json
+import sqlite3
+from unittest.mock import patch
 
 import pytest
-import pytest_asyncio
 import aiosqlite
 
-from db import init_db, upsert_chat, upsert_user, insert_message, insert_event, commit
+from db import init_db, upsert_chat, upsert_user, insert_message, insert_event, commit, MessageTxn, flusher, open_read_db
 
 
-@pytest_asyncio.fixture
+@pytest.fixture
 async def db():
     """Create an in-memory SQLite database for testing."""
     conn = await init_db(":memory:")
@@ -17,7 +19,6 @@ async def db():
 
 # --- init_db tests ---
 
-@pytest.mark.asyncio
 async def test_init_db_creates_all_tables(db):
     cursor = await db.execute(
         "SELECT name FROM sqlite_master WHERE type='table' ORDER BY name"
@@ -29,29 +30,47 @@ async def test_init_db_creates_all_tables(db):
     assert "events" in tables
 
 
-@pytest.mark.asyncio
 async def test_init_db_wal_mode(db):
     cursor = await db.execute("PRAGMA journal_mode")
     row = await cursor.fetchone()
     # In-memory databases may report "memory" instead of "wal"
     assert row[0] in ("wal", "memory")
+    cursor = await db.execute("PRAGMA synchronous")
+    row = await cursor.fetchone()
+    assert row[0] == 1  # NORMAL
 
 
-@pytest.mark.asyncio
 async def test_init_db_creates_indexes(db):
     cursor = await db.execute(
         "SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'idx_%'"
     )
     indexes = [row[0] for row in await cursor.fetchall()]
     assert "idx_messages_chat_date" in indexes
-    assert "idx_messages_user" in indexes
+    assert "idx_messages_user_date" in indexes
+    assert "idx_messages_user" not in indexes
     assert "idx_messages_msg_chat" in indexes
     assert "idx_events_chat_date" in indexes
 
 
+async def test_open_read_db_is_read_only(tmp_path):
+    path = str(tmp_path / "logger.db")
+    write_db = await init_db(path)
+    read_db = await open_read_db(path)
+    try:
+        await upsert_chat(write_db, -1001, "Chat", "group")
+        await commit(write_db)
+        cursor = await read_db.execute("SELECT title FROM chats WHERE chat_id = -1001")
+        row = await cursor.fetchone()
+        assert row[0] == "Chat"
+        with pytest.raises(aiosqlite.OperationalError):
+            await upsert_chat(read_db, -1002, "Other", "group")
+    finally:
+        await read_db.close()
+        await write_db.close()
+
+
 # --- upsert_chat tests ---
 
-@pytest.mark.asyncio
 async def test_upsert_chat_insert(db):
     await upsert_chat(db, chat_id=-1001, title="Test Group", chat_type="supergroup")
     cursor = await db.execute("SELECT * FROM chats WHERE chat_id = -1001")
@@ -62,7 +81,6 @@ async def test_upsert_chat_insert(db):
     assert row[3] is not None  # updated_at
 
 
-@pytest.mark.asyncio
 async def test_upsert_chat_update(db):
     await upsert_chat(db, chat_id=-1001, title="Old Name", chat_type="group")
     await upsert_chat(db, chat_id=-1001, title="New Name", chat_type="supergroup")
@@ -72,9 +90,15 @@ async def test_upsert_chat_update(db):
     assert row[1] == "supergroup"
 
 
+async def test_upsert_chat_explicit_updated_at(db):
+    await upsert_chat(db, -1001, "Chat", "group", updated_at="2026-02-22 10:00:00")
+    cursor = await db.execute("SELECT updated_at FROM chats WHERE chat_id = -1001")
+    row = await cursor.fetchone()
+    assert row[0] == "2026-02-22 10:00:00"
+
+
 # --- upsert_user tests ---
 
-@pytest.mark.asyncio
 async def test_upsert_user_insert(db):
     await upsert_user(db, user_id=100, username="testuser", first_name="Test", last_name="User")
     cursor = await db.execute("SELECT * FROM users WHERE user_id = 100")
@@ -85,7 +109,6 @@ async def test_upsert_user_insert(db):
     assert row[3] == "User"
 
 
-@pytest.mark.asyncio
 async def test_upsert_user_update(db):
     await upsert_user(db, user_id=100, username="old", first_name="Old", last_name="Name")
     await upsert_user(db, user_id=100, username="new", first_name="New", last_name="Name")
@@ -97,7 +120,6 @@ async def test_upsert_user_update(db):
 
 # --- insert_message tests ---
 
-@pytest.mark.asyncio
 async def test_insert_message_text(db):
     await upsert_chat(db, -1001, "Chat", "group")
     await upsert_user(db, 100, "user", "First", "Last")
@@ -113,9 +135,9 @@ async def test_insert_message_text(db):
     assert row[5] == "text"  # type
     assert row[6] == "Hello world"  # text
     assert row[12] == 0      # is_edit
+    assert row[13] is not None  # created_at
 
 
-@pytest.mark.asyncio
 async def test_insert_message_with_user_id_none(db):
     """Channel posts may have no from_user."""
     await upsert_chat(db, -1001, "Channel", "channel")
@@ -128,7 +150,6 @@ async def test_insert_message_with_user_id_none(db):
     assert row[0] is None
 
 
-@pytest.mark.asyncio
 async def test_insert_message_with_media_meta(db):
     await upsert_chat(db, -1001, "Chat", "group")
     await upsert_user(db, 100, "user", "First", "Last")
@@ -146,7 +167,6 @@ async def test_insert_message_with_media_meta(db):
     assert parsed["mime"] == "image/jpeg"
 
 
-@pytest.mark.asyncio
 async def test_insert_message_media_meta_strips_nulls(db):
     await upsert_chat(db, -1001, "Chat", "group")
     meta = {"size": 100, "mime": "video/mp4", "name": None, "duration": 30}
@@ -161,7 +181,6 @@ async def test_insert_message_media_meta_strips_nulls(db):
     assert parsed["duration"] == 30
 
 
-@pytest.mark.asyncio
 async def test_insert_message_edit(db):
     await upsert_chat(db, -1001, "Chat", "group")
     await insert_message(
@@ -174,7 +193,6 @@ async def test_insert_message_edit(db):
     assert row[0] == 1
 
 
-@pytest.mark.asyncio
 async def test_insert_message_with_reply_and_forward(db):
     await upsert_chat(db, -1001, "Chat", "group")
     await insert_message(
@@ -193,7 +211,6 @@ async def test_insert_message_with_reply_and_forward(db):
 
 # --- insert_event tests ---
 
-@pytest.mark.asyncio
 async def test_insert_event(db):
     await upsert_chat(db, -1001, "Chat", "group")
     await insert_event(
@@ -208,9 +225,9 @@ async def test_insert_event(db):
     assert row[3] == "member_joined"  # type
     parsed = json.loads(row[4])
     assert parsed["username"] == "newuser"
+    assert row[6] is not None       # created_at
 
 
-@pytest.mark.asyncio
 async def test_insert_event_without_data(db):
     await upsert_chat(db, -1001, "Chat", "group")
     await insert_event(
@@ -220,3 +237,172 @@ async def test_insert_event_without_data(db):
     cursor = await db.execute("SELECT data FROM events")
     row = await cursor.fetchone()
     assert row[0] is None
+
+
+# --- MessageTxn tests ---
+
+async def test_message_txn_writes_all_rows(db):
+    async with MessageTxn(db) as tx:
+        tx.add_chat(-1001, "Chat", "group")
+        tx.add_user(100, "user", "First", "Last")
+        tx.add_message(
+            msg_id=1, chat_id=-1001, user_id=100,
+            date="2026-02-22T10:00:00", msg_type="text", text="Hello",
+        )
+        tx.add_event(
+            chat_id=-1001, event_type="member_joined",
+            date="2026-02-22T10:00:00", user_id=100,
+        )
+    assert not db.in_transaction
+
+    cursor = await db.execute("SELECT title FROM chats WHERE chat_id = -1001")
+    assert (await cursor.fetchone())[0] == "Chat"
+    cursor = await db.execute("SELECT username FROM users WHERE user_id = 100")
+    assert (await cursor.fetchone())[0] == "user"
+    cursor = await db.execute("SELECT text FROM messages WHERE msg_id = 1")
+    assert (await cursor.fetchone())[0] == "Hello"
+    cursor = await db.execute("SELECT type FROM events")
+    assert (await cursor.fetchone())[0] == "member_joined"
+
+
+async def test_message_txn_keeps_order_within_statement(db):
+    async with MessageTxn(db) as tx:
+        tx.add_chat(-1001, "Old Name", "group")
+        tx.add_chat(-1001, "New Name", "group")
+    cursor = await db.execute("SELECT title FROM chats WHERE chat_id = -1001")
+    row = await cursor.fetchone()
+    assert row[0] == "New Name"
+
+
+async def test_message_txn_collapses_repeated_upserts(db):
+    statements = []
+    await db.set_trace_callback(statements.append)
+    async with MessageTxn(db) as tx:
+        tx.add_user(100, "old", "Old", "Name")
+        tx.add_user(100, "new", "New", "Name")
+        tx.add_user(200, "other", "Other", "User")
+    await db.set_trace_callback(None)
+
+    assert sum("INSERT INTO users" in sql for sql in statements) == 2
+    cursor = await db.execute("SELECT username FROM users ORDER BY user_id")
+    assert [row[0] for row in await cursor.fetchall()] == ["new", "other"]
+
+
+async def test_message_txn_mass_join_uses_one_transaction(db):
+    statements = []
+    await db.set_trace_callback(statements.append)
+    async with MessageTxn(db) as tx:
+        tx.add_chat(-1001, "Chat", "group")
+        for user_id in range(200, 250):
+            tx.add_user(user_id, f"user{user_id}", "New", None)
+            tx.add_event(
+                chat_id=-1001, event_type="member_joined",
+                date="2026-02-22T10:00:00", user_id=user_id,
+                data={"username": f"user{user_id}", "first_name": "New"},
+            )
+    await db.set_trace_callback(None)
+
+    assert sum(sql.startswith("BEGIN") for sql in statements) == 1
+    cursor = await db.execute("SELECT COUNT(*) FROM users")
+    assert (await cursor.fetchone())[0] == 50
+    cursor = await db.execute("SELECT COUNT(*) FROM events WHERE type = 'member_joined'")
+    assert (await cursor.fetchone())[0] == 50
+
+
+async def test_message_txn_discards_rows_on_error(db):
+    with pytest.raises(RuntimeError):
+        async with MessageTxn(db) as tx:
+            tx.add_chat(-1001, "Chat", "group")
+            raise RuntimeError("boom")
+    cursor = await db.execute("SELECT COUNT(*) FROM chats")
+    row = await cursor.fetchone()
+    assert row[0] == 0
+
+
+async def test_message_txn_rolls_back_failed_commit(db):
+    with patch.object(db, "commit", side_effect=sqlite3.OperationalError("disk I/O error")):
+        with pytest.raises(sqlite3.OperationalError):
+            async with MessageTxn(db) as tx:
+                tx.add_chat(-1001, "Chat", "group")
+    assert not db.in_transaction
+
+    # The connection is still usable for the next update
+    async with MessageTxn(db) as tx:
+        tx.add_chat(-1002, "Chat", "group")
+    cursor = await db.execute("SELECT chat_id FROM chats")
+    assert [row[0] for row in await cursor.fetchall()] == [-1002]
+
+
+# --- flusher tests ---
+
+async def test_flusher_commits_queued_txns(db):
+    queue = asyncio.Queue()
+    task = asyncio.create_task(flusher(db, queue))
+
+    for msg_id in (1, 2):
+        async with MessageTxn(db, queue) as tx:
+            tx.add_chat(-1001, "Chat", "group")
+            tx.add_message(
+                msg_id=msg_id, chat_id=-1001, user_id=None,
+                date="2026-02-22T10:00:00", msg_type="text", text="Hello",
+            )
+
+    await queue.put(None)
+    await task
+
+    cursor = await db.execute("SELECT msg_id FROM messages ORDER BY msg_id")
+    assert [row[0] for row in await cursor.fetchall()] == [1, 2]
+    assert not db.in_transaction
+
+
+
+async def test_flusher_keeps_message_arrival_order(db):
+    queue = asyncio.Queue()
+    for msg_id, media_file_id in ((1, None), (2, "photo_abc"), (3, None)):
+        async with MessageTxn(db, queue) as tx:
+            tx.add_chat(-1001, "Chat", "group")
+            tx.add_message(
+                msg_id=msg_id, chat_id=-1001, user_id=None,
+                date="2026-02-22T10:00:00", msg_type="photo" if media_file_id else "text",
+                media_file_id=media_file_id,
+            )
+    await queue.put(None)
+
+    # Text and photo rows use different statements but land in one batch
+    await flusher(db, queue)
+
+    cursor = await db.execute("SELECT msg_id FROM messages ORDER BY id")
+    assert [row[0] for row in await cursor.fetchall()] == [1, 2, 3]
+
+async def test_flusher_survives_failed_batch(db):
+    queue = asyncio.Queue()
+    task = asyncio.create_task(flusher(db, queue, interval=0))
+
+    queue.put_nowait([("INSERT INTO missing_table VALUES (?)", (1,))])
+    await asyncio.sleep(0.01)
+    async with MessageTxn(db, queue) as tx:
+        tx.add_chat(-1001, "Chat", "group")
+    await queue.put(None)
+    await task
+
+    cursor = await db.execute("SELECT COUNT(*) FROM chats")
+    row = await cursor.fetchone()
+    assert row[0] == 1
+
+
+async def test_flusher_keeps_good_updates_from_failed_batch(db):
+    queue = asyncio.Queue()
+    for chat_id in (-1001, -1002):
+        async with MessageTxn(db, queue) as tx:
+            tx.add_chat(chat_id, "Chat", "group")
+    queue.put_nowait([("INSERT INTO missing_table VALUES (?)", (1,))])
+    async with MessageTxn(db, queue) as tx:
+        tx.add_chat(-1003, "Chat", "group")
+    await queue.put(None)
+
+    # All four updates are queued before the flusher starts, so they share a batch
+    await flusher(db, queue)
+
+    cursor = await db.execute("SELECT chat_id FROM chats ORDER BY chat_id DESC")
+    assert [row[0] for row in await cursor.fetchall()] == [-1001, -1002, -1003]
+    assert not db.in_transaction
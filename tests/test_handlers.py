@@ -1,48 +1,156 @@
+import asyncio
 import json
+import os
+from dataclasses import dataclass, replace
 from datetime import datetime, timezone
+from typing import Optional
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
-import pytest_asyncio
 import aiosqlite
+from aiogram import Bot, Dispatcher, Router
+from aiogram.enums import ContentType
+from aiogram.types import (
+    Chat, Message, PhotoSize, Update, User,
+    MessageOriginUser, MessageOriginHiddenUser, MessageOriginChat, MessageOriginChannel,
+)
 
 from config import Config
-from db import init_db
-from handlers import setup_router, _extract_forward_info, _extract_media_meta, _sanitize_filename
+from db import init_db, flusher
+from handlers import (
+    MEDIA_CONTENT_TYPES, setup_router, _extract_forward_info, _extract_media_meta,
+    _download_media, _sanitize_filename, _is_non_command_text, _META_BUILDERS,
+)
 
 
-@pytest_asyncio.fixture
-async def db():
+@pytest.fixture(scope="session")
+async def _db_conn():
+    """One in-memory database for the whole session; the schema is created once."""
     conn = await init_db(":memory:")
+    # Nothing here needs to survive a crash: drop journaling and fsync work
+    for pragma in (
+        "journal_mode=MEMORY",
+        "synchronous=OFF",
+        "temp_store=MEMORY",
+        "locking_mode=EXCLUSIVE",
+        "cache_size=-64000",
+    ):
+        await conn.execute(f"PRAGMA {pragma}")
     yield conn
     await conn.close()
 
 
 @pytest.fixture
-def config(tmp_path):
+async def db(_db_conn):
+    """Per-test view of the shared database, emptied after each test.
+
+    Handlers commit their own transactions, so a wrapping savepoint can't
+    be used for isolation.
+    """
+    yield _db_conn
+    await _db_conn.executescript(
+        "DELETE FROM messages; DELETE FROM events; DELETE FROM users; DELETE FROM chats;"
+    )
+
+
+@pytest.fixture(scope="session")
+def config(tmp_path_factory):
     return Config(
         bot_token="test_token",
         download_media=False,
-        data_dir=tmp_path,
+        data_dir=tmp_path_factory.mktemp("data"),
     )
 
 
+@pytest.fixture(scope="session")
+async def bot():
+    bot = Bot("42:TEST")
+    yield bot
+    await bot.session.close()
+
+
+@pytest.fixture(scope="session")
+def dp(_db_conn, config):
+    """Dispatcher wired with the same DI keys as bot.py; writes go straight to the db."""
+    dp = Dispatcher()
+    dp.include_router(setup_router())
+    dp["db_write"] = _db_conn
+    dp["config"] = config
+    dp["write_queue"] = None
+    return dp
+
+
+# Plain stand-ins for the aiogram objects handlers only read attributes from
+
+@dataclass
+class FakeChat:
+    id: int
+    title: Optional[str]
+    type: str
+
+
+@dataclass
+class FakeUser:
+    id: int
+    username: Optional[str]
+    first_name: str
+    last_name: Optional[str]
+
+    @property
+    def full_name(self):
+        return f"{self.first_name} {self.last_name}"
+
+
+@dataclass
+class FakePhotoSize:
+    file_id: str
+    file_size: int
+    width: int
+    height: int
+
+
+@dataclass
+class FakeDocument:
+    file_id: str
+    file_size: int
+    mime_type: str
+    file_name: str
+
+
+@dataclass
+class FakeSticker:
+    file_id: str
+    emoji: str
+    set_name: str
+    width: int
+    height: int
+
+
 def _make_chat(chat_id=-1001, title="Test Group", chat_type="supergroup"):
-    chat = MagicMock()
-    chat.id = chat_id
-    chat.title = title
-    chat.type = chat_type
-    return chat
+    return FakeChat(id=chat_id, title=title, type=chat_type)
 
 
 def _make_user(user_id=100, username="testuser", first_name="Test", last_name="User"):
-    user = MagicMock()
-    user.id = user_id
-    user.username = username
-    user.first_name = first_name
-    user.last_name = last_name
-    user.full_name = f"{first_name} {last_name}"
-    return user
+    return FakeUser(id=user_id, username=username, first_name=first_name, last_name=last_name)
+
+
+# Shared defaults for _make_message; tests never mutate them
+_DEFAULT_CHAT = _make_chat()
+_DEFAULT_USER = _make_user()
+
+# Every test message carries this date
+_TEST_DATE = datetime(2026, 2, 22, 10, 0, 0, tzinfo=timezone.utc)
+_TEST_DATE_ISO = _TEST_DATE.isoformat()
+
+# Attributes of aiogram's Message that handlers read
+_MSG_SPEC = (
+    "text", "chat", "from_user", "message_id", "content_type",
+    "date", "reply_to_message", "forward_origin",
+    "photo", "video", "document", "audio", "voice",
+    "video_note", "sticker", "animation", "caption",
+    "new_chat_members", "left_chat_member", "new_chat_title",
+    "pinned_message", "bot",
+)
 
 
 def _make_message(
@@ -66,21 +174,15 @@ def _make_message(
     left_chat_member=None,
     new_chat_title=None,
     pinned_message=None,
+    bot=None,
 ):
-    msg = MagicMock(spec=[
-        "text", "chat", "from_user", "message_id", "content_type",
-        "date", "reply_to_message", "forward_origin",
-        "photo", "video", "document", "audio", "voice",
-        "video_note", "sticker", "animation", "caption",
-        "new_chat_members", "left_chat_member", "new_chat_title",
-        "pinned_message", "bot",
-    ])
+    msg = MagicMock(spec=_MSG_SPEC)
     msg.text = text
-    msg.chat = chat or _make_chat()
-    msg.from_user = from_user if from_user is not None else _make_user()
+    msg.chat = chat or _DEFAULT_CHAT
+    msg.from_user = from_user if from_user is not None else _DEFAULT_USER
     msg.message_id = message_id
     msg.content_type = content_type
-    msg.date = datetime(2026, 2, 22, 10, 0, 0, tzinfo=timezone.utc)
+    msg.date = _TEST_DATE
     msg.reply_to_message = reply_to_message
     msg.forward_origin = forward_origin
     msg.photo = photo
@@ -96,275 +198,223 @@ def _make_message(
     msg.left_chat_member = left_chat_member
     msg.new_chat_title = new_chat_title
     msg.pinned_message = pinned_message
-    msg.bot = AsyncMock()
+    msg.bot = bot
     return msg
 
 
 # --- _extract_forward_info tests ---
 
-def test_extract_forward_info_none():
-    msg = _make_message(forward_origin=None)
-    fwd_from, fwd_name = _extract_forward_info(msg)
-    assert fwd_from is None
-    assert fwd_name is None
-
-
-def test_extract_forward_info_user():
-    from aiogram.types import MessageOriginUser
-    user = _make_user(user_id=200, first_name="Fwd", last_name="User")
-    origin = MagicMock(spec=MessageOriginUser)
-    origin.sender_user = user
-    msg = _make_message(forward_origin=origin)
-    fwd_from, fwd_name = _extract_forward_info(msg)
-    assert fwd_from == 200
-    assert fwd_name == "Fwd User"
-
-
-def test_extract_forward_info_hidden_user():
-    from aiogram.types import MessageOriginHiddenUser
-    origin = MagicMock(spec=MessageOriginHiddenUser)
-    origin.sender_user_name = "Hidden Person"
-    msg = _make_message(forward_origin=origin)
-    fwd_from, fwd_name = _extract_forward_info(msg)
-    assert fwd_from is None
-    assert fwd_name == "Hidden Person"
-
-
-def test_extract_forward_info_chat():
-    from aiogram.types import MessageOriginChat
-    chat = MagicMock()
-    chat.id = -5001
-    chat.title = "Some Chat"
-    origin = MagicMock(spec=MessageOriginChat)
-    origin.sender_chat = chat
-    msg = _make_message(forward_origin=origin)
-    fwd_from, fwd_name = _extract_forward_info(msg)
-    assert fwd_from == -5001
-    assert fwd_name == "Some Chat"
-
-
-def test_extract_forward_info_channel():
-    from aiogram.types import MessageOriginChannel
-    chat = MagicMock()
-    chat.id = -6001
-    chat.title = "News Channel"
-    origin = MagicMock(spec=MessageOriginChannel)
-    origin.chat = chat
-    msg = _make_message(forward_origin=origin)
-    fwd_from, fwd_name = _extract_forward_info(msg)
-    assert fwd_from == -6001
-    assert fwd_name == "News Channel"
-
-
-# --- _extract_media_meta tests ---
-
-def test_extract_media_meta_photo():
-    from aiogram.enums import ContentType
-    photo_size = MagicMock()
-    photo_size.file_id = "photo_123"
-    photo_size.file_size = 50000
-    photo_size.width = 1920
-    photo_size.height = 1080
-    msg = _make_message(content_type=ContentType.PHOTO, photo=[photo_size])
-    file_id, meta, msg_type = _extract_media_meta(msg)
-    assert file_id == "photo_123"
-    assert meta["size"] == 50000
-    assert meta["width"] == 1920
-    assert msg_type == "photo"
-
-
-def test_extract_media_meta_document():
-    from aiogram.enums import ContentType
-    doc = MagicMock()
-    doc.file_id = "doc_456"
-    doc.file_size = 100000
-    doc.mime_type = "application/pdf"
-    doc.file_name = "report.pdf"
-    msg = _make_message(content_type=ContentType.DOCUMENT, document=doc)
-    file_id, meta, msg_type = _extract_media_meta(msg)
-    assert file_id == "doc_456"
-    assert meta["mime"] == "application/pdf"
-    assert meta["name"] == "report.pdf"
-    assert msg_type == "document"
-
-
-def test_extract_media_meta_sticker():
-    from aiogram.enums import ContentType
-    sticker = MagicMock()
-    sticker.file_id = "sticker_789"
-    sticker.emoji = "😀"
-    sticker.set_name = "HappyPack"
-    sticker.width = 512
-    sticker.height = 512
-    msg = _make_message(content_type=ContentType.STICKER, sticker=sticker)
-    file_id, meta, msg_type = _extract_media_meta(msg)
-    assert file_id == "sticker_789"
-    assert meta["emoji"] == "😀"
-    assert msg_type == "sticker"
-
+def _origin(spec, **attrs):
+    origin = MagicMock(spec=spec)
+    for name, value in attrs.items():
+        setattr(origin, name, value)
+    return origin
 
-# --- Handler integration tests (using db directly) ---
 
-@pytest.mark.asyncio
-async def test_text_message_logged(db, config):
-    """Simulate what the text handler does."""
-    from db import upsert_chat, upsert_user, insert_message
+@pytest.mark.parametrize("forward_origin,expected", [
+    (None, (None, None)),
+    (
+        _origin(MessageOriginUser, sender_user=_make_user(user_id=200, first_name="Fwd", last_name="User")),
+        (200, "Fwd User"),
+    ),
+    (_origin(MessageOriginHiddenUser, sender_user_name="Hidden Person"), (None, "Hidden Person")),
+    (_origin(MessageOriginChat, sender_chat=_make_chat(chat_id=-5001, title="Some Chat")), (-5001, "Some Chat")),
+    (_origin(MessageOriginChannel, chat=_make_chat(chat_id=-6001, title="News Channel")), (-6001, "News Channel")),
+], ids=["none", "user", "hidden_user", "chat", "channel"])
+def test_extract_forward_info(forward_origin, expected):
+    msg = _make_message(forward_origin=forward_origin)
+    assert _extract_forward_info(msg) == expected
 
-    msg = _make_message(text="Hello world")
-
-    # Simulate handler logic
-    await upsert_chat(db, msg.chat.id, msg.chat.title, msg.chat.type)
-    await upsert_user(db, msg.from_user.id, msg.from_user.username, msg.from_user.first_name, msg.from_user.last_name)
-    await insert_message(
-        db, msg_id=msg.message_id, chat_id=msg.chat.id,
-        user_id=msg.from_user.id, date=msg.date.isoformat(),
-        msg_type="text", text=msg.text,
-    )
 
-    # Verify
-    cursor = await db.execute("SELECT text, type FROM messages WHERE msg_id = 1")
-    row = await cursor.fetchone()
-    assert row[0] == "Hello world"
-    assert row[1] == "text"
-
-    cursor = await db.execute("SELECT title FROM chats WHERE chat_id = ?", (msg.chat.id,))
-    row = await cursor.fetchone()
-    assert row[0] == "Test Group"
-
-    cursor = await db.execute("SELECT username FROM users WHERE user_id = ?", (msg.from_user.id,))
-    row = await cursor.fetchone()
-    assert row[0] == "testuser"
-
-
-@pytest.mark.asyncio
-async def test_media_message_meta_logged(db, config):
-    """Simulate what the media handler does for a photo."""
-    from aiogram.enums import ContentType
-    from db import upsert_chat, upsert_user, insert_message
-
-    photo_size = MagicMock()
-    photo_size.file_id = "photo_abc"
-    photo_size.file_size = 99000
-    photo_size.width = 800
-    photo_size.height = 600
-
-    msg = _make_message(
-        content_type=ContentType.PHOTO,
-        photo=[photo_size],
-        caption="Nice photo!",
-    )
+# --- _extract_media_meta tests ---
 
+@pytest.mark.parametrize("content_type,media,expected_file_id,expected_meta,expected_type", [
+    (
+        ContentType.PHOTO,
+        {"photo": [FakePhotoSize(file_id="photo_123", file_size=50000, width=1920, height=1080)]},
+        "photo_123", {"size": 50000, "width": 1920}, "photo",
+    ),
+    (
+        ContentType.DOCUMENT,
+        {"document": FakeDocument(
+            file_id="doc_456", file_size=100000, mime_type="application/pdf", file_name="report.pdf",
+        )},
+        "doc_456", {"mime": "application/pdf", "name": "report.pdf"}, "document",
+    ),
+    (
+        ContentType.STICKER,
+        {"sticker": FakeSticker(file_id="sticker_789", emoji="😀", set_name="HappyPack", width=512, height=512)},
+        "sticker_789", {"emoji": "😀"}, "sticker",
+    ),
+], ids=["photo", "document", "sticker"])
+def test_extract_media_meta(content_type, media, expected_file_id, expected_meta, expected_type):
+    msg = _make_message(content_type=content_type, **media)
     file_id, meta, msg_type = _extract_media_meta(msg)
-
-    await upsert_chat(db, msg.chat.id, msg.chat.title, msg.chat.type)
-    await upsert_user(db, msg.from_user.id, msg.from_user.username, msg.from_user.first_name, msg.from_user.last_name)
-    await insert_message(
-        db, msg_id=msg.message_id, chat_id=msg.chat.id,
-        user_id=msg.from_user.id, date=msg.date.isoformat(),
-        msg_type=msg_type, text=msg.caption,
-        media_file_id=file_id, media_meta=meta,
-    )
-
-    cursor = await db.execute("SELECT type, text, media_file_id, media_meta FROM messages")
-    row = await cursor.fetchone()
-    assert row[0] == "photo"
-    assert row[1] == "Nice photo!"
-    assert row[2] == "photo_abc"
-    parsed = json.loads(row[3])
-    assert parsed["size"] == 99000
-
-
-@pytest.mark.asyncio
-async def test_message_with_from_user_none(db, config):
-    """Channel posts have no from_user — should not crash."""
-    from db import upsert_chat, insert_message
-
-    msg = _make_message(text="Channel announcement")
-    msg.from_user = None
-
-    await upsert_chat(db, msg.chat.id, msg.chat.title, msg.chat.type)
-
-    user_id = msg.from_user.id if msg.from_user else None
-    await insert_message(
-        db, msg_id=msg.message_id, chat_id=msg.chat.id,
-        user_id=user_id, date=msg.date.isoformat(),
-        msg_type="text", text=msg.text,
-    )
-
-    cursor = await db.execute("SELECT user_id, text FROM messages")
-    row = await cursor.fetchone()
-    assert row[0] is None
-    assert row[1] == "Channel announcement"
-
-
-@pytest.mark.asyncio
-async def test_edited_message_has_is_edit_flag(db, config):
-    """Edited messages should be logged with is_edit=True."""
-    from db import upsert_chat, upsert_user, insert_message
-
-    msg = _make_message(text="Corrected text")
-
-    await upsert_chat(db, msg.chat.id, msg.chat.title, msg.chat.type)
-    await upsert_user(db, msg.from_user.id, msg.from_user.username, msg.from_user.first_name, msg.from_user.last_name)
-    await insert_message(
-        db, msg_id=msg.message_id, chat_id=msg.chat.id,
-        user_id=msg.from_user.id, date=msg.date.isoformat(),
-        msg_type="text", text=msg.text, is_edit=True,
-    )
-
-    cursor = await db.execute("SELECT is_edit, text FROM messages")
-    row = await cursor.fetchone()
-    assert row[0] == 1
-    assert row[1] == "Corrected text"
-
-
-@pytest.mark.asyncio
-async def test_service_event_member_joined(db, config):
+    assert file_id == expected_file_id
+    assert expected_meta.items() <= meta.items()
+    assert msg_type == expected_type
+
+
+def test_media_content_types_have_meta_builders():
+    assert set(_META_BUILDERS) == MEDIA_CONTENT_TYPES
+
+
+# --- Handler integration tests (updates fed through the dispatcher) ---
+
+_CHAT = Chat(id=-1001, type="supergroup", title="Test Group")
+_SENDER = User(id=100, is_bot=False, first_name="Test", last_name="User", username="testuser")
+_PHOTO = PhotoSize(file_id="photo_abc", file_unique_id="u_photo_abc", width=800, height=600, file_size=99000)
+_PHOTO_META = {"size": 99000, "width": 800, "height": 600}
+
+
+def _update(edited=False, from_user=_SENDER, **message_fields):
+    """Build an Update carrying a message (or an edit) in the test chat."""
+    message = Message(message_id=1, date=_TEST_DATE, chat=_CHAT, from_user=from_user, **message_fields)
+    return Update(update_id=1, **{"edited_message" if edited else "message": message})
+
+
+async def _one(db, sql, params=()):
+    """Fetch the first row of a query in a single round trip."""
+    rows = await db.execute_fetchall(sql, params)
+    return rows[0]
+
+
+@pytest.mark.parametrize("update,expected", [
+    (
+        _update(text="Hello world"),
+        {"type": "text", "text": "Hello world", "user_id": 100, "is_edit": 0, "date": _TEST_DATE_ISO,
+         "title": "Test Group", "username": "testuser"},
+    ),
+    (
+        _update(edited=True, text="Corrected text"),
+        {"type": "text", "text": "Corrected text", "is_edit": 1},
+    ),
+    (
+        _update(from_user=None, text="Anonymous admin post"),
+        {"text": "Anonymous admin post", "user_id": None, "username": None},
+    ),
+    (
+        _update(photo=[_PHOTO], caption="Nice photo!"),
+        {"type": "photo", "text": "Nice photo!", "media_file_id": "photo_abc", "media_meta": _PHOTO_META},
+    ),
+    (
+        _update(edited=True, photo=[_PHOTO], caption="New caption"),
+        {"type": "photo", "text": "New caption", "is_edit": 1},
+    ),
+], ids=["text", "edited", "no_sender", "photo", "edited_photo"])
+async def test_message_logged(db, dp, bot, update, expected):
+    await dp.feed_update(bot, update)
+
+    columns = ("type", "text", "user_id", "is_edit", "date", "media_file_id", "media_meta", "title", "username")
+    row = await _one(db, """
+        SELECT m.type, m.text, m.user_id, m.is_edit, m.date, m.media_file_id, m.media_meta, c.title, u.username
+        FROM messages m
+        JOIN chats c ON c.chat_id = m.chat_id
+        LEFT JOIN users u ON u.user_id = m.user_id
+    """)
+    stored = dict(zip(columns, row))
+    if stored["media_meta"] is not None:
+        stored["media_meta"] = json.loads(stored["media_meta"])
+    for column, value in expected.items():
+        assert stored[column] == value
+    assert not db.in_transaction
+
+
+async def test_service_event_member_joined(db, dp, bot):
     """Member join event should be logged to events table."""
-    from db import upsert_chat, upsert_user, insert_event
+    new_member = User(id=200, is_bot=False, first_name="New", last_name="Guy", username="newguy")
+    await dp.feed_update(bot, _update(new_chat_members=[new_member]))
 
-    new_member = _make_user(user_id=200, username="newguy", first_name="New", last_name="Guy")
-    msg = _make_message(new_chat_members=[new_member])
-
-    await upsert_chat(db, msg.chat.id, msg.chat.title, msg.chat.type)
-    await upsert_user(db, new_member.id, new_member.username, new_member.first_name, new_member.last_name)
-    await insert_event(
-        db, chat_id=msg.chat.id, event_type="member_joined",
-        date=msg.date.isoformat(), user_id=new_member.id,
-        data={"username": new_member.username, "first_name": new_member.first_name},
-    )
-
-    cursor = await db.execute("SELECT type, user_id, data FROM events")
-    row = await cursor.fetchone()
+    row = await _one(db, "SELECT type, user_id, data FROM events")
     assert row[0] == "member_joined"
     assert row[1] == 200
     parsed = json.loads(row[2])
     assert parsed["username"] == "newguy"
+    row = await _one(db, "SELECT first_name FROM users WHERE user_id = 200")
+    assert row[0] == "New"
+
+
+async def test_message_logged_through_write_queue(db, dp, bot):
+    """With a write_queue, as in bot.py, rows reach the db via the flusher."""
+    queue = asyncio.Queue()
+    await dp.feed_update(bot, _update(text="Queued"), write_queue=queue)
+    assert queue.qsize() == 1
+
+    await queue.put(None)
+    await flusher(db, queue)
+
+    row = await _one(db, "SELECT m.text, c.title FROM messages m JOIN chats c ON c.chat_id = m.chat_id")
+    assert row == ("Queued", "Test Group")
+
+
+@pytest.mark.parametrize("get_file_error", [None, RuntimeError("network down")], ids=["ok", "get_file_fails"])
+async def test_media_download_runs_with_write(db, dp, bot, config, get_file_error):
+    """With DOWNLOAD_MEDIA on, the row is queued and the download finishes before the handler returns."""
+    queue = asyncio.Queue()
+    get_file = AsyncMock(return_value=MagicMock(file_path="photos/file_1.jpg"), side_effect=get_file_error)
+    download_file = AsyncMock()
+    with patch.object(bot, "get_file", get_file), patch.object(bot, "download_file", download_file):
+        await dp.feed_update(
+            bot, _update(photo=[_PHOTO]),
+            config=replace(config, download_media=True), write_queue=queue,
+        )
+
+    get_file.assert_awaited_once_with("photo_abc")
+    if get_file_error is None:
+        download_file.assert_awaited_once_with(
+            "photos/file_1.jpg", os.path.join(config.media_dir, "-1001_1_file_1.jpg"),
+        )
+    else:
+        download_file.assert_not_awaited()
+
+    # A failed download never costs the row
+    assert queue.qsize() == 1
+    await queue.put(None)
+    await flusher(db, queue)
+    row = await _one(db, "SELECT type, media_file_id FROM messages")
+    assert row == ("photo", "photo_abc")
+
+
+@pytest.mark.parametrize("text,expected", [
+    ("Hello", True),
+    ("", False),
+    ("/start", False),
+    (None, False),
+])
+async def test_is_non_command_text(text, expected):
+    assert await _is_non_command_text(_make_message(text=text)) is expected
+
+
+async def test_download_media_saves_to_media_dir(config):
+    msg = _make_message(message_id=7, bot=AsyncMock())
+    msg.bot.get_file.return_value = MagicMock(file_path="photos/file_1.jpg")
+    await _download_media(msg, config, "photo_abc")
+    msg.bot.download_file.assert_awaited_once_with(
+        "photos/file_1.jpg", os.path.join(config.media_dir, "-1001_7_file_1.jpg"),
+    )
+
+
+async def test_download_media_failure_is_logged_not_raised(config):
+    msg = _make_message(bot=AsyncMock())
+    msg.bot.get_file.side_effect = RuntimeError("network down")
+    await _download_media(msg, config, "photo_abc")
+    msg.bot.download_file.assert_not_awaited()
 
 
-@pytest.mark.asyncio
 async def test_setup_router_returns_router():
     """setup_router should return a Router instance."""
-    from aiogram import Router
     router = setup_router()
     assert isinstance(router, Router)
 
 
 # --- _sanitize_filename tests ---
 
-def test_sanitize_filename_normal():
-    assert _sanitize_filename("photo.jpg") == "photo.jpg"
-
-
-def test_sanitize_filename_with_path():
-    assert _sanitize_filename("photos/file_123.jpg") == "file_123.jpg"
-
-
-def test_sanitize_filename_with_dots_traversal():
-    assert _sanitize_filename("../../etc/passwd") == "passwd"
-
-
-def test_sanitize_filename_with_special_chars():
-    result = _sanitize_filename("file name (1).jpg")
-    assert "/" not in result
-    assert ".." not in result
+@pytest.mark.parametrize("name,check", [
+    ("photo.jpg", lambda r: r == "photo.jpg"),
+    ("photos/file_123.jpg", lambda r: r == "file_123.jpg"),
+    ("../../etc/passwd", lambda r: r == "passwd"),
+    ("file name (1).jpg", lambda r: "/" not in r and ".." not in r),
+    ("фото (1).jpg", lambda r: r == "фото__1_.jpg"),
+], ids=["normal", "with_path", "dots_traversal", "special_chars", "non_ascii"])
+def test_sanitize_filename(name, check):
+    assert check(_sanitize_filename(name))